@@ -6,20 +6,29 @@ report. This runs genbranch in both uncached and cached modes and reports
 average timings as well as speedup information for cached operations.
 """
 import argparse
+import array
+import concurrent.futures
+import contextlib
+import math
 import os
 import os.path
+import queue
 import statistics
 import subprocess
 import sys
 import tempfile
 import time
 
+NSEC_PER_SEC = 1_000_000_000
+
 
 def gitp(*args, **kw):
     cmd = ("git", *args)
     kw.setdefault("check", True)
     kw.setdefault("text", True)
     kw.setdefault("stdout", subprocess.PIPE)
+    # Allow subprocess to use posix_spawn() instead of fork() + exec()
+    kw.setdefault("close_fds", False)
     return subprocess.run(cmd, **kw)
 
 
@@ -49,12 +58,25 @@ def parse_args(argv):
         dest="cached",
         help="""Do not run cached genbranch.""",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="""Number of uncached genbranch operations to run concurrently,
+        each one in its own temporary worktrees. Cached genbranch operations
+        always run sequentially since they share the cache file. Note that
+        concurrent operations compete for resources, which affects timings.""",
+    )
 
     args = parser.parse_args(argv)
 
     if args.n <= 0:
         parser.error("argument to -n must be a non-zero positive integer")
 
+    if args.jobs <= 0:
+        parser.error("argument to -j must be a non-zero positive integer")
+
     if not args.uncached and not args.cached:
         parser.error("at least one mode (cached or uncached) must be enabled")
 
@@ -72,6 +94,28 @@ def status(msg, **kw):
     info(f"\r\033[K{msg}", **kw)
 
 
+class RunningStats:
+    """
+    Mean and standard deviation of a series of values, updated in constant time
+    as each value is added (Welford's online algorithm).
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0
+        self._m2 = 0
+
+    def add(self, x):
+        self.n += 1
+        d = x - self.mean
+        self.mean += d / self.n
+        self._m2 += d * (x - self.mean)
+
+    @property
+    def stdev(self):
+        return math.sqrt(self._m2 / (self.n - 1)) if self.n > 1 else 0
+
+
 def run_genbranch_operations(repo_info, num_pile_commits, cached):
     if cached:
         cache_file = tempfile.NamedTemporaryFile(delete=False, dir=repo_info["git_dir"])
@@ -85,28 +129,26 @@ def run_genbranch_operations(repo_info, num_pile_commits, cached):
         genbranch_cmd += ("--no-cache",)
         status_prefix = "Running uncached genbranch"
 
-    timings = []
-    cur_avg = 0
-    cur_std = 0
+    # Timings are kept in nanoseconds and only converted to seconds for display
+    timings = array.array("q", [0] * num_pile_commits)
+    stats = RunningStats()
     try:
         git("checkout", "--detach", "-q")
 
         # Define a common starting point. Note that this also initializes the
         # cache for cached mode.
         info(f"Running genbranch for {repo_info['pile_branch']}~{num_pile_commits} to initialize")
-        git("-C", repo_info["patches_dir"], "checkout", "-q", "-f", "--detach", f"{repo_info['pile_branch']}~{num_pile_commits}")
+        git("-C", repo_info["patches_dir"], "checkout", "-q", "-f", "--detach", repo_info["pile_revs"][0])
         gitp(*genbranch_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
-        for i in reversed(range(num_pile_commits)):
-            git("-C", repo_info["patches_dir"], "checkout", "-q", "-f", "--detach", f"{repo_info['pile_branch']}~{i}")
-            status(f"{status_prefix} [{num_pile_commits - i}/{num_pile_commits}] (cur_avg={cur_avg:.3f}±{cur_std:.3f})")
-            t0 = time.monotonic()
+        for i in range(1, num_pile_commits + 1):
+            git("-C", repo_info["patches_dir"], "checkout", "-q", "-f", "--detach", repo_info["pile_revs"][i])
+            status(f"{status_prefix} [{i}/{num_pile_commits}] (cur_avg={stats.mean:.3f}±{stats.stdev:.3f})")
+            t0 = time.perf_counter_ns()
             gitp(*genbranch_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            dt = time.monotonic() - t0
-            timings.append(dt)
-            cur_avg = statistics.mean(timings) if len(timings) > 0 else 0
-            cur_std = statistics.stdev(timings) if len(timings) > 1 else 0
-            status(f"{status_prefix} [{num_pile_commits - i}/{num_pile_commits}] (cur_avg={cur_avg:.3f}±{cur_std:.3f})")
+            timings[i - 1] = time.perf_counter_ns() - t0
+            stats.add(timings[i - 1] / NSEC_PER_SEC)
+            status(f"{status_prefix} [{i}/{num_pile_commits}] (cur_avg={stats.mean:.3f}±{stats.stdev:.3f})")
         info()
     finally:
         if cached:
@@ -114,7 +156,62 @@ def run_genbranch_operations(repo_info, num_pile_commits, cached):
     return timings
 
 
+def run_uncached_genbranch_operations_parallel(repo_info, num_pile_commits, jobs):
+    status_prefix = f"Running uncached genbranch with {jobs} jobs"
+    pile_revs = repo_info["pile_revs"][1:]
+    timings = array.array("q", [0] * num_pile_commits)
+    stats = RunningStats()
+
+    with contextlib.ExitStack() as exit_stack:
+        # Each worker needs private checkouts of both the pile and the result
+        # branch, so they can't interfere with each other.
+        workdirs = queue.Queue()
+        for _ in range(jobs):
+            d = exit_stack.enter_context(tempfile.TemporaryDirectory(prefix="time-genbranch-"))
+            pile_dir = os.path.join(d, "pile")
+            result_dir = os.path.join(d, "result")
+            for path, rev in ((pile_dir, repo_info["pile_branch"]), (result_dir, "HEAD")):
+                git("worktree", "add", "-q", "--detach", path, rev)
+                exit_stack.callback(git, "worktree", "remove", "--force", path)
+            workdirs.put((pile_dir, result_dir))
+
+        def genbranch_task(rev):
+            pile_dir, result_dir = workdirs.get()
+            try:
+                git("-C", pile_dir, "checkout", "-q", "-f", "--detach", rev)
+                t0 = time.perf_counter_ns()
+                # Setting core.splitIndex explicitly keeps genbranch from
+                # changing the config shared by all workers.
+                gitp(
+                    *("-C", result_dir, "-c", "core.splitIndex=true"),
+                    *("pile", "--no-config", "genbranch", "-i", "--no-cache", "-e", pile_dir),
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+                return time.perf_counter_ns() - t0
+            finally:
+                workdirs.put((pile_dir, result_dir))
+
+        pool = exit_stack.enter_context(concurrent.futures.ThreadPoolExecutor(max_workers=jobs))
+        futures = {pool.submit(genbranch_task, rev): i for i, rev in enumerate(pile_revs)}
+
+        status(f"{status_prefix} [0/{num_pile_commits}]")
+        for future in concurrent.futures.as_completed(futures):
+            dt = future.result()
+            timings[futures[future]] = dt
+            stats.add(dt / NSEC_PER_SEC)
+            status(f"{status_prefix} [{stats.n}/{num_pile_commits}] (cur_avg={stats.mean:.3f}±{stats.stdev:.3f})")
+        info()
+
+    return timings
+
+
 def print_report(uncached_timings, cached_timings):
+    if uncached_timings:
+        uncached_timings = [dt / NSEC_PER_SEC for dt in uncached_timings]
+    if cached_timings:
+        cached_timings = [dt / NSEC_PER_SEC for dt in cached_timings]
+
     avg_data = []
 
     if uncached_timings:
@@ -181,6 +278,13 @@ def main(argv=None):
         "pile_branch": git("config", "pile.pile-branch"),
     }
 
+    # Resolve the pile revisions to use once, so they can be checked out by
+    # sha1: pile_revs[i] is pile_branch~(n - i)
+    pile_revs = git("rev-list", "--first-parent", "--reverse", "-n", str(args.n + 1), repo_info["pile_branch"]).split()
+    if len(pile_revs) <= args.n:
+        sys.exit(f"error: {repo_info['pile_branch']} must have more than {args.n} commits")
+    repo_info["pile_revs"] = pile_revs
+
     os.chdir(repo_info["toplevel"])
 
     saved_rev = git("branch", "--show-current") or git("rev-parse", "HEAD")
@@ -190,7 +294,9 @@ def main(argv=None):
 
     uncached_timings, cached_timings = None, None
     try:
-        if args.uncached:
+        if args.uncached and args.jobs > 1:
+            uncached_timings = run_uncached_genbranch_operations_parallel(repo_info, num_pile_commits=args.n, jobs=args.jobs)
+        elif args.uncached:
             uncached_timings = run_genbranch_operations(repo_info, num_pile_commits=args.n, cached=False)
 
         if args.cached:
@@ -64,8 +64,9 @@ Notes regarding ``PileCommand`` subclasses:
   - There are two main methods expected to be implemented by subclasses:
 
     1. ``init()``: this is where initialization (like adding arguments) is done.
-       This method is called when the command is added to a ``PileCLI``
-       instance.
+       This method is called by the ``PileCLI`` instance the command was added
+       to, only when the command is about to be used (i.e. when parsing
+       arguments for it).
 
     2. ``run()``: this is the method called by ``PileCLI`` when to run this
        command.
@@ -85,6 +86,7 @@ Notes regarding ``PileCommand`` subclasses:
 
 """
 import argparse
+import re
 import sys
 import textwrap
 
@@ -92,6 +94,9 @@ from . import __version__
 from . import config as configmod
 from . import helpers
 
+# Any uppercase letter but the first one, to convert camel case to dashes
+_CAMEL_CASE_RE = re.compile(r"(?<!^)([A-Z])")
+
 
 class PileCommand:
     def __init_subclass__(cls, **kw):
@@ -99,11 +104,12 @@ class PileCommand:
         if not hasattr(cls, "name"):
             cls.name = cls.__default_cmd_name()
 
-        if not hasattr(cls, "parser_description"):
-            cls.parser_description = textwrap.dedent(cls.__doc__)
-
+        # The description derived from the docstring is only needed when the
+        # command is initialized, so it's left to PileCLI. The first line
+        # of the docstring is the same with or without dedenting it.
         if not hasattr(cls, "parser_help"):
-            cls.parser_help, _, _ = cls.parser_description.strip().partition("\n")
+            description = getattr(cls, "parser_description", cls.__doc__)
+            cls.parser_help, _, _ = description.strip().partition("\n")
 
         if not hasattr(cls, "supports_no_config"):
             cls.supports_no_config = False
@@ -116,8 +122,7 @@ class PileCommand:
         name = cls.__name__
         if name.endswith("Cmd"):
             name = name[:-3]
-        name = name[0].lower() + "".join(f"-{c.lower()}" if c.isalpha() and c.isupper() else c for c in name[1:])
-        return name
+        return _CAMEL_CASE_RE.sub(r"-\1", name).lower()
 
     def run(self):
         raise NotImplementedError()
@@ -148,6 +153,7 @@ class PileCLI:
         )
 
         self.subparsers = self.parser.add_subparsers(title="Commands", dest="command")
+        self.__uninitialized_cmds = {}
 
     def __onetime_config_setup(self, args, cmd):
         self.__onetime_config_setup = lambda *_: None
@@ -163,11 +169,23 @@ class PileCLI:
                     helpers.fatal("Could not find checkout for result-branch / pile-branch")
 
     def add_command(self, cmd_cls):
-        cmd = cmd_cls()
-
         parser_kw = {k[7:]: v for k, v in cmd_cls.__dict__.items() if k.startswith("parser_")}
         parser = self.subparsers.add_parser(cmd_cls.name, **parser_kw)
 
+        # Creating the command and adding its arguments is deferred until it's
+        # about to be used: usually only one of them is needed per invocation
+        self.__uninitialized_cmds[cmd_cls.name] = cmd_cls, parser
+
+    def __init_command(self, name):
+        try:
+            cmd_cls, parser = self.__uninitialized_cmds.pop(name)
+        except KeyError:
+            return
+
+        if "parser_description" not in cmd_cls.__dict__:
+            parser.description = textwrap.dedent(cmd_cls.__doc__)
+
+        cmd = cmd_cls()
         cmd.parser = parser
         cmd.cli = self
 
@@ -182,7 +200,21 @@ class PileCLI:
         )
         parser.set_defaults(cmd_object=cmd)
 
+    def init_commands(self):
+        """
+        Initialize all commands, for when the arguments of all of them are
+        needed (e.g. for argument completion).
+        """
+        for name in list(self.__uninitialized_cmds):
+            self.__init_command(name)
+
     def parse_args(self, argv=sys.argv[1:]):
+        # Global options don't take values, so the first positional argument
+        # is the command
+        name = next((a for a in argv if not a.startswith("-")), None)
+        if name:
+            self.__init_command(name)
+
         return self.parser.parse_args(argv)
 
     def run(self, args):
@@ -21,6 +21,10 @@ from .helpers import (
 )
 
 
+# Map a config name (without the "pile." prefix) to the Config attribute name
+_CONFIG_KEY_TO_ATTR = str.maketrans("-.", "__")
+
+
 class Config:
     __attr_doc_dir = "(path): Directory with PILE_BRANCH checkout (path)"
     __attr_doc_linear_branch = (
@@ -37,6 +41,7 @@ class Config:
     __attr_doc_genbranch_user_email = "(string): E-mail to use as committer when generating the commits"
     __attr_doc_genbranch_use_cache = "(bool): Use cached information to avoid recreating commits"
     __attr_doc_genbranch_cache_path = "(path): Path (relative to the .git dir) to the cache file for genbranch"
+    __attr_doc_genbranch_worktree_path = "(path): Path inside the .git dir (relative to it) to a worktree kept to be reused by genbranch. If empty, a temporary worktree is created on each run"
 
     def __init__(self, skip_load=False):
         if git_worktree_config_extension_enabled():
@@ -67,6 +72,7 @@ class Config:
         self.genbranch_user_email = None
         self.genbranch_use_cache = True
         self.genbranch_cache_path = "pile-genbranch-cache.pickle"
+        self.genbranch_worktree_path = ""
 
     def load_config_values(self, root):
         self._set_defaults(root)
@@ -83,7 +89,7 @@ class Config:
                 value = None
 
             # pile.*
-            key = key[5:].translate(str.maketrans("-.", "__"))
+            key = key[5:].translate(_CONFIG_KEY_TO_ATTR)
             try:
                 if hasattr(self, key) and isinstance(getattr(self, key), bool):
                     value = self._value_to_bool(value)
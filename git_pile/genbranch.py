@@ -9,15 +9,18 @@ import os.path as op
 import pathlib
 import subprocess
 import sys
+import threading
 
 from .config import Config
 from .cli import PileCommand
 from .genbranch_caching import GenbranchCache
 from .gitutil import (
+    git_reusable_worktree,
     git_split_index,
     git_temporary_worktree,
     git_worktree_get_checkout_path,
     git_worktree_get_git_dir,
+    git_worktree_head,
 )
 from .helpers import (
     error,
@@ -87,7 +90,11 @@ def genbranch_with_exit_stack(config, args, exit_stack):
             apply_cmd.append("--whitespace=fix")
             cache_not_allowed_reasons.append("using option --fix-whitespace")
 
-        env = os.environ.copy()
+        # only copy the environment if there's anything to override
+        env = None
+        if config.genbranch_user_name or config.genbranch_user_email:
+            env = os.environ.copy()
+
         if config.genbranch_user_name:
             env["GIT_COMMITTER_NAME"] = config.genbranch_user_name
 
@@ -106,6 +113,9 @@ def genbranch_with_exit_stack(config, args, exit_stack):
         if not config.genbranch_cache_path:
             fatal("Missing cache path (config value for pile.genbranch-cache-path is empty)")
         cache_path = op.join(git_worktree_get_git_dir(config.root, force_absolute=True), config.genbranch_cache_path)
+        # ask git even if both name and email are configured: git normalizes
+        # them (e.g. dropping surrounding whitespace and crud) and the cache
+        # needs to use the same ident as the commits
         committer_ident = git(["var", "GIT_COMMITTER_IDENT"], env=env).stdout
         cache = GenbranchCache(cache_path, committer_ident=committer_ident)
         # Use Pile from a revision if possible, so we do not calculate sha1 for
@@ -115,10 +125,17 @@ def genbranch_with_exit_stack(config, args, exit_stack):
 
         if not cache_pile_rev:
             try:
-                if git(["-C", patchesdir, "status", "--porcelain"], stderr=nul_f).stdout.strip() == "":
-                    cache_pile_rev = git(["-C", patchesdir, "rev-parse", "HEAD"]).stdout.strip()
+                status = git(["-C", patchesdir, "status", "--porcelain=v2", "--branch"], stderr=nul_f).stdout.splitlines()
             except subprocess.CalledProcessError:
-                pass
+                status = []
+
+            # A single git-status tells both if the checkout is clean (only
+            # header lines) and the commit in HEAD (first header line:
+            # "# branch.oid <commit>", or "(initial)" if there's none yet)
+            if status and all(l.startswith("#") for l in status):
+                head_oid = status[0].split()[2]
+                if head_oid != "(initial)":
+                    cache_pile_rev = head_oid
 
         if cache_pile_rev:
             pile_for_cache = Pile(rev=cache_pile_rev, rev_repo_path=patchesdir, baseline=args.baseline)
@@ -145,15 +162,24 @@ def genbranch_with_exit_stack(config, args, exit_stack):
         if not args.branch:
             # use whatever is currently checked out, might as well be in
             # detached state
-            git(f"reset --hard {effective_baseline}")
+            git(["reset", "--hard", effective_baseline])
         else:
-            git(f"checkout -B {args.branch} {effective_baseline}")
+            git(["checkout", "-B", args.branch, effective_baseline])
 
         any_fallback = False
 
         if patchlist:
             with git_split_index():
-                ret = git_can_fail(apply_cmd + patchlist, stdout=stdout, stderr=stderr, env=env, start_new_session=True)
+                ret = apply_patches(
+                    git_can_fail,
+                    apply_cmd,
+                    patchlist,
+                    mbox=not args.dirty,
+                    stdout=stdout,
+                    stderr=stderr,
+                    env=env,
+                    start_new_session=True,
+                )
                 while ret.returncode != 0:
                     if not git_am_apply_fallbacks(apply_cmd, args, stdout, stderr, env):
                         break
@@ -191,39 +217,106 @@ pile patches."""
 
         return 0
 
-    # work in a separate directory to avoid cluttering whatever the user is doing
-    # on the main one
-    with git_temporary_worktree(effective_baseline, config.root) as d:
-        branch = args.branch if args.branch else config.result_branch
-        path = git_worktree_get_checkout_path(config.root, branch)
+    branch = args.branch if args.branch else config.result_branch
+    path = git_worktree_get_checkout_path(config.root, branch)
 
-        if path and not args.force:
-            error(f"can't use branch '{branch}' because it is checked out at '{path}'")
-            return 1
+    if path and not args.force:
+        error(f"can't use branch '{branch}' because it is checked out at '{path}'")
+        return 1
+
+    if patchlist or args.dirty:
+        d = None
+        if config.genbranch_worktree_path and not args.dirty:
+            gitdir = git_worktree_get_git_dir(config.root, force_absolute=True)
+            d = exit_stack.enter_context(git_reusable_worktree(effective_baseline, gitdir, config.genbranch_worktree_path))
+
+        if d is None:
+            # work in a separate directory to avoid cluttering whatever the user is doing
+            # on the main one
+            d = exit_stack.enter_context(git_temporary_worktree(effective_baseline, config.root))
 
         if patchlist:
-            git(["-C", d] + apply_cmd + patchlist, stdout=stdout, stderr=stderr, env=env)
+            apply_patches(git, ["-C", d] + apply_cmd, patchlist, mbox=not args.dirty, stdout=stdout, stderr=stderr, env=env)
 
         if args.dirty:
             raise git_temporary_worktree.Break
 
-        head = git(["-C", d, "rev-parse", "HEAD"]).stdout.strip()
+        head = git_worktree_head(d)
+    else:
+        # Nothing to apply on top of the baseline (e.g. all the commits came
+        # from the cache), so there's no need to check out a worktree
+        head = git(["rev-parse", "--verify", f"{effective_baseline}^{{commit}}"]).stdout.strip()
 
-        if cache:
-            cache.update(pile_for_cache, head)
-            cache.save()
+    if cache:
+        cache.update(pile_for_cache, head)
+        cache.save()
 
-        if path:
-            # args.force checked earlier
-            git(f"-C {path} reset --hard {head}", stdout=nul_f, stderr=nul_f)
-        else:
-            git(f"-C {d} checkout -f -B {branch} {head}", stdout=nul_f, stderr=nul_f)
+    if path:
+        # args.force checked earlier
+        git(["-C", path, "reset", "--hard", head], stdout=nul_f, stderr=nul_f)
+    else:
+        git(["branch", "-f", branch, head], stdout=nul_f, stderr=nul_f)
 
     return 0
 
 
+# Apply @patchlist by calling @run (git or git_can_fail) with @cmd. If @mbox is
+# True (for git-am), the patches are given as a single mbox through stdin rather
+# than as arguments, since a pile big enough would exceed the limit on the size
+# of the command line.
+def apply_patches(run, cmd, patchlist, mbox=False, **kwargs):
+    if not mbox:
+        return run(cmd + patchlist, **kwargs)
+
+    with mbox_pipe(patchlist) as f:
+        return run(cmd, stdin=f, **kwargs)
+
+
+# Concatenate the patch files in @patchlist into an mbox and yield the read end
+# of a pipe it's written to by a background thread. All the patches are read
+# before yielding, so a patch that can't be read is fatal before anything is
+# applied rather than silently truncating the mbox.
+#
+# To be used in `with` context handling.
+@contextlib.contextmanager
+def mbox_pipe(patchlist):
+    mbox = []
+    for p in patchlist:
+        try:
+            with open(p, "rb") as f:
+                data = f.read()
+        except OSError as e:
+            fatal(f"could not read patch: {e}")
+
+        # keep each patch in its own message, even for files not generated by
+        # git-format-patch
+        if not data.startswith(b"From "):
+            mbox.append(b"From 0000000000000000000000000000000000000000 Mon Sep 17 00:00:00 2001\n")
+        mbox.append(data)
+        if not data.endswith(b"\n"):
+            mbox.append(b"\n")
+
+    r, w = os.pipe()
+
+    def feed():
+        with open(w, "wb") as out:
+            try:
+                out.writelines(mbox)
+            except BrokenPipeError:
+                # reader is gone
+                pass
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    try:
+        with open(r, "rb") as f:
+            yield f
+    finally:
+        feeder.join()
+
+
 def check_baseline_exists(baseline):
-    ret = git_can_fail("cat-file -e {baseline}".format(baseline=baseline))
+    ret = git_can_fail(["cat-file", "-e", baseline])
     if ret.returncode != 0:
         fatal(
             f"""baseline commit '{baseline}' not found!
@@ -254,25 +347,24 @@ def git_am_apply_fallbacks(apply_cmd, args, stdout, stderr, env):
         fallback_apply_reset()
 
         # record previously untracked files so we don't add them later
-        untracked_files = []
-        for l in git("status --porcelain").stdout.splitlines():
-            if l[0] == "?" and l[1] == "?":
-                f = pathlib.Path(l.split()[1])
-                untracked_files += []
+        untracked_files = {l[3:] for l in git_status_porcelain() if l.startswith("??")}
 
         patch_can_fail = run_wrapper("patch", capture=True, check=False)
         ret = patch_can_fail(f"-p1 -i {cur_patch}", stdout=stdout, stderr=stderr, env=env, start_new_session=True)
         if ret.returncode == 0:
-            for l in git("status --porcelain").stdout.splitlines():
-                f = pathlib.Path(l.split()[1])
-                if l[0] == "?" and l[1] == "?" and f not in untracked_files:
-                    git(f"add {f}")
-                else:
-                    git(f"add {f}")
+            changed_files = [l[3:] for l in git_status_porcelain() if l[3:] not in untracked_files]
+            if changed_files:
+                git(["add", "--", *changed_files])
 
     return ret.returncode == 0
 
 
+# Return the entries of `git status --porcelain` for the current worktree. The
+# -z format is used so paths are never quoted.
+def git_status_porcelain():
+    return git("status --porcelain -z").stdout.split("\0")[:-1]
+
+
 def should_try_fuzzy(args, msg):
     if args.fuzzy is None:
         if sys.stdin.isatty():
@@ -288,13 +380,9 @@ def should_try_fuzzy(args, msg):
 
 def fallback_apply_reset():
     git("reset --hard HEAD")
-    status = git("status --porcelain").stdout.splitlines()
 
     # remove any untracked file left by git-apply or patch (*.rej, *.orig)
-    for l in status:
-        if l[0] == "?" and l[1] == "?" and (l.endswith(".rej") or l.endswith(".orig")):
-            f = pathlib.Path(l.split()[1])
-            f.unlink(missing_ok=True)
+    git(["clean", "-fq", "--", "*.rej", "*.orig"])
 
 
 class GenbranchCmd(PileCommand):
@@ -9,13 +9,13 @@ genbranch operation from unnecessarily regenerating commits objects. More
 information about the tree structure can be found in the documentation for the
 internal class ``_Node``.
 """
-import collections
 import logging
 import pathlib
 import pickle
-import subprocess
+import sys
 import tempfile
 
+from .gitutil import git_cat_file_batch
 from .helpers import git
 
 
@@ -45,6 +45,8 @@ class GenbranchCache:
         """
         self.__path = pathlib.Path(path)
         self.__cache_data = _CacheData.load(self.__path)
+        # Whether the cache differs from what is stored in self.__path
+        self.__modified = False
 
         if not committer_ident:
             committer_ident = git(["var", "GIT_COMMITTER_IDENT"]).stdout
@@ -53,6 +55,7 @@ class GenbranchCache:
 
         if self.__committer_ident not in self.__cache_data.trees:
             self.__cache_data.trees[self.__committer_ident] = _Node(None)
+            self.__modified = True
         self.__root = self.__cache_data.trees[self.__committer_ident]
 
     def search_best_base(self, pile, baseline=None):
@@ -91,7 +94,7 @@ class GenbranchCache:
             except KeyError:
                 break
 
-        # Do a binary search to minimize calls to `git cat-file`.
+        # Do a binary search to minimize object lookups with `git cat-file`.
         # The following algorithm has the following invariants:
         #
         #   1) all nodes in ``node[0:base + 1]`` have existing commit objects.
@@ -104,14 +107,23 @@ class GenbranchCache:
         # baseline for genbranch.
         base = 0
         head = len(nodes) - 1
-        while base < head:
-            i = (base + head + 1) // 2
-            try:
-                git(["cat-file", "-e", nodes[i].commit], stderr=subprocess.DEVNULL)
-            except subprocess.CalledProcessError:
-                head = i - 1
-            else:
-                base = i
+        if base < head:
+            with git_cat_file_batch(contents=False) as cat_file:
+                # Most of the time nothing was garbage collected since the
+                # commits were created, so check the deepest node first: if it
+                # still exists, a single lookup is enough.
+                if cat_file(nodes[head].commit)[0] is not None:
+                    base = head
+                else:
+                    head -= 1
+
+                while base < head:
+                    i = (base + head + 1) // 2
+                    objecttype, _ = cat_file(nodes[i].commit)
+                    if objecttype is None:
+                        head = i - 1
+                    else:
+                        base = i
 
         return nodes[base].commit, base
 
@@ -129,21 +141,32 @@ class GenbranchCache:
 
         if baseline not in self.__root.children:
             self.__root.children[baseline] = _Node(baseline)
+            self.__modified = True
 
         node = self.__root.children[baseline]
         for patch_sha1, commit in zip(series_hashes, commits):
             if patch_sha1 not in node.children or node.children[patch_sha1].commit != commit:
-                node.children[patch_sha1] = _Node(commit)
+                node.children[sys.intern(patch_sha1)] = _Node(sys.intern(commit))
+                self.__modified = True
             node = node.children[patch_sha1]
 
     def save(self, path=None):
         """
         Write cache data back to the file system.
 
-        By default, the same path passed to the constructor is used. The
-        parameter ``path`` can be used to provide an alternative destination.
+        By default, the same path passed to the constructor is used, in which
+        case nothing is written if the cache was not modified since it was
+        loaded. The parameter ``path`` can be used to provide an alternative
+        destination.
         """
-        self.__cache_data.save(pathlib.Path(path or self.__path))
+        if path is None:
+            if not self.__modified:
+                return
+            path = self.__path
+
+        self.__cache_data.save(pathlib.Path(path))
+        if pathlib.Path(path) == self.__path:
+            self.__modified = False
 
 
 _logger = logging.getLogger(__name__)
@@ -185,15 +208,20 @@ class _Node:
     In order to allow building the path for a pile revision, each node has a
     ``children`` attribute as a ``dict`` mapping the sha-1 hash of each child's
     patch file to the child node object.
+
+    Cache trees can have a lot of nodes, so ``__slots__`` is used to keep their
+    memory footprint low.
     """
 
+    __slots__ = ("children", "commit")
+
     def __init__(self, commit):
         self.children = {}
         self.commit = commit
 
 
 class _CacheData:
-    SCHEMA_VERSION = 2
+    SCHEMA_VERSION = 5
 
     def __init__(self):
         self.trees = {}
@@ -201,13 +229,14 @@ class _CacheData:
     @classmethod
     def load(cls, path):
         try:
+            # The file is made of two pickles: the schema version, followed by
+            # the cache data, which is only read if the version matches.
             with open(path, "rb") as f:
-                schema_version, data_bytes = pickle.load(f)
+                schema_version = pickle.load(f)
+                if schema_version == cls.SCHEMA_VERSION:
+                    return pickle.load(f)
 
-            if schema_version == cls.SCHEMA_VERSION:
-                return pickle.loads(data_bytes)
-            else:
-                _logger.info(f"creating new cache structure because {path} uses a different schema version.")
+            _logger.info(f"creating new cache structure because {path} uses a different schema version.")
         except FileNotFoundError:
             _logger.info(f"creating new cache structure because {path} does not exist yet.")
         except Exception as e:
@@ -218,12 +247,12 @@ class _CacheData:
         return _CacheData()
 
     def save(self, path):
-        data_bytes = pickle.dumps(self)
         # Using dir=output_path.parent to ensure files will be in the same file
         # system for the atomic replace operation.
         f = tempfile.NamedTemporaryFile(delete=False, dir=path.parent)
         try:
-            pickle.dump((self.SCHEMA_VERSION, data_bytes), f)
+            pickle.dump(self.SCHEMA_VERSION, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
         except Exception:  # pragma: no cover
             f.close()
             pathlib.Path(f.name).unlink()
@@ -244,47 +273,43 @@ class _CacheData:
         state["trees"] = {k: self.__unflatten_tree(flat_data) for k, flat_data in state["trees"].items()}
         self.__dict__.update(state)
 
+    # Trees are stored as flat lists of edges ``(parent_index, key, commit)``,
+    # listed in breadth-first order so that a parent always comes before its
+    # children. The first entry is the root, with ``parent_index == -1``.
+    # Hashes are stored as raw bytes, which takes half the space of their hex
+    # representation.
     def __flatten_tree(self, root):
-        stack = collections.deque([[root, list(root.children), -1]])
-        flat_data = []
-        while stack:
-            node, children_keys, child_idx = stack[-1]
-            if child_idx == -1:
-                node_dict = dict(node.__dict__)
-                node_dict.pop("children")
-                flat_data.append(("node-start", node_dict))
-                stack[-1][-1] += 1
-            elif child_idx < len(children_keys):
-                child_key = children_keys[child_idx]
-                child = node.children[child_key]
-                flat_data.append(("node-child", child_key))
-                stack[-1][-1] += 1
-                stack.append([child, list(child.children), -1])
-            else:
-                flat_data.append(("node-end", None))
-                stack.pop()
-        return flat_data
-
-    def __unflatten_tree(self, flat_data):
-        _, node_dict = flat_data[0]
-        root = _Node.__new__(_Node)
-        root.__dict__.update(node_dict)
-        root.children = {}
-        stack = collections.deque([root])
-        for entry_type, entry_data in flat_data[1:]:
-            if entry_type == "node-start":
-                child_key = stack.pop()
-                node_dict = entry_data
-                node = _Node.__new__(_Node)
-                node.__dict__.update(node_dict)
-                node.children = {}
-                stack[-1].children[child_key] = node
-                stack.append(node)
-            elif entry_type == "node-child":
-                key = entry_data
-                stack.append(key)
-            elif entry_type == "node-end":
-                stack.pop()
-            else:
-                raise Exception(f"unexpected entry type: {entry_type}")  # pragma: no cover
-        return root
+        nodes = [root]
+        edges = [(-1, None, _pack_hash(root.commit))]
+        # nodes grows while being iterated, visiting each level in turn
+        for idx, node in enumerate(nodes):
+            for key, child in node.children.items():
+                nodes.append(child)
+                edges.append((idx, _pack_hash(key), _pack_hash(child.commit)))
+        return edges
+
+    def __unflatten_tree(self, edges):
+        nodes = []
+        for parent_idx, key, commit in edges:
+            # The same patches show up in many paths of the tree (and in the
+            # trees of other committers): interning their hashes keeps a
+            # single copy of each string in memory.
+            node = _Node(None if commit is None else sys.intern(_unpack_hash(commit)))
+            if parent_idx >= 0:
+                nodes[parent_idx].children[sys.intern(_unpack_hash(key))] = node
+            nodes.append(node)
+        return nodes[0]
+
+
+# Convert the hex string @h to bytes. Values that don't round trip (e.g. a
+# baseline passed as a ref name instead of a hash) are returned unchanged.
+def _pack_hash(h):
+    try:
+        b = bytes.fromhex(h)
+    except (TypeError, ValueError):
+        return h
+    return b if b.hex() == h else h
+
+
+def _unpack_hash(h):
+    return h.hex() if isinstance(h, bytes) else h
@@ -2,11 +2,11 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
 import argparse
-import email
-import email.header
 import math
 import os
 import os.path as op
+import re
+import shutil
 import subprocess
 import sys
 import tempfile
@@ -19,17 +19,21 @@ from .cli import PileCLI, PileCommand
 from .config import Config
 from .gitutil import (
     git_branch_exists,
+    git_cat_file_batch,
     git_get_editor,
     git_init,
     git_ref_exists,
     git_ref_is_ancestor,
-    git_remote_branch_exists,
+    git_refs,
+    git_rev_parse_list,
     git_root_or_die,
     git_temporary_worktree,
+    git_user_name_email,
     git_worktree_get_checkout_path,
     git_worktree_get_git_dir,
 )
 from .helpers import (
+    child_input_file,
     error,
     fatal,
     git,
@@ -56,6 +60,17 @@ except ImportError:
 
 MIN_GIT_VERSION = "2.20"
 
+# 1:  34cf518f0aab ! 1:  3a4e12046539 <commit message>
+RANGE_DIFF_LINE_RE = re.compile(r"^ *(?:-|\d+): +(\S+) ([<>=!]) +(?:-|\d+): +(\S+)(?: .*)?$", re.M)
+
+# Conflict in a patch file in which only the hunk header differs: we can just
+# keep the hunk header from the patch being applied
+DIFF_HUNK_CONFLICT_RE = re.compile(rb"^<<<<<<< HEAD.*\n@@.*\n=======.*\n(@@.*)\n>>>>>>>.*$", re.M)
+CONFLICT_MARKER_RE = re.compile(rb"^<<<<<<< HEAD", re.M)
+
+# index 1ac1b9e..5d6b3f4 100644
+DIFF_INDEX_LINE_RE = re.compile(r"^index [0-9a-f]+\.\.[0-9a-f]+.*\n", re.M)
+
 
 def log10_or_zero(n):
     return math.log10(n) if n else 0
@@ -110,13 +125,11 @@ def get_branch_from_remote_branch(remote_branch):
 
 def assert_valid_result_branch(result_branch, baseline):
     try:
-        git(f"rev-parse {baseline}", stderr=nul_f)
-    except subprocess.CalledProcessError:
-        fatal(f"invalid baseline commit {baseline}")
-
-    try:
-        out = git(f"merge-base {baseline} {result_branch}").stdout.strip()
+        out = git(["merge-base", baseline, result_branch], stderr=nul_f).stdout.strip()
     except subprocess.CalledProcessError:
+        # only pay for a separate check to give a better error message
+        if not git_rev_parse_list([baseline]):
+            fatal(f"invalid baseline commit {baseline}")
         out = None
 
     if out != baseline:
@@ -274,17 +287,22 @@ class SetupCmd(PileCommand):
         create_pile_branch = True
         create_result_branch = True
 
-        if git_remote_branch_exists(args.pile_branch):
+        # all the local and remote branches, to check the ones we are given
+        refs = git_refs(["refs/heads", "refs/remotes"])
+
+        remote_pile_ref = f"refs/remotes/{args.pile_branch}"
+        if remote_pile_ref in refs:
             local_pile_branch = get_branch_from_remote_branch(args.pile_branch)
-            if git_branch_exists(local_pile_branch):
+            local_pile_ref = f"refs/heads/{local_pile_branch}"
+            if local_pile_ref in refs:
                 # allow case that e.g. 'origin/pile' and 'pile' point to the same commit
-                if git(f"rev-parse {args.pile_branch}").stdout == git(f"rev-parse {local_pile_branch}").stdout:
+                if refs[remote_pile_ref] == refs[local_pile_ref]:
                     create_pile_branch = False
                 elif not args.force:
                     fatal(
                         f"using '{args.pile_branch}' for pile but branch '{local_pile_branch}' already exists and point elsewhere"
                     )
-        elif git_branch_exists(args.pile_branch):
+        elif f"refs/heads/{args.pile_branch}" in refs:
             local_pile_branch = args.pile_branch
             create_pile_branch = False
         else:
@@ -300,17 +318,19 @@ class SetupCmd(PileCommand):
             fatal(f"no argument passed for result branch and no branch is currently checkout at '{gitroot}'")
 
         # same as for pile branch but allow for non-existent result branch, we will just create one
-        if git_remote_branch_exists(result_branch):
+        remote_result_ref = f"refs/remotes/{result_branch}"
+        if remote_result_ref in refs:
             local_result_branch = get_branch_from_remote_branch(result_branch)
-            if git_branch_exists(local_result_branch):
+            local_result_ref = f"refs/heads/{local_result_branch}"
+            if local_result_ref in refs:
                 # allow case that e.g. 'origin/internal' and 'internal' point to the same commit
-                if git(f"rev-parse {result_branch}").stdout == git(f"rev-parse {local_result_branch}").stdout:
+                if refs[remote_result_ref] == refs[local_result_ref]:
                     create_result_branch = False
                 elif not args.force:
                     fatal(
                         f"using '{result_branch}' for result but branch '{local_result_branch}' already exists and point elsewhere"
                     )
-        elif git_branch_exists(result_branch):
+        elif f"refs/heads/{result_branch}" in refs:
             local_result_branch = result_branch
             create_result_branch = False
         else:
@@ -394,42 +414,56 @@ def fix_duplicate_patch_names(patches):
     if len(set(patches)) == len(patches):
         return patches
 
-    # deduplicate
+    # deduplicate: remember the next suffix to try for each name so a
+    # name repeated many times doesn't restart the search from "-2"
     ret = []
-    max_retries = len(patches) + 2
+    used = set()
+    next_retry = {}
     for p in patches:
         newp = p
-        retry = 2
-        while newp in ret:
-            if retry > max_retries:
-                raise Exception(f"wat!?! '{p}' (max_retries={max_retries})")
-            newp = p + "-%d" % retry
+        retry = next_retry.get(p, 2)
+        while newp in used:
+            newp = f"{p}-{retry}"
             retry += 1
 
+        next_retry[p] = retry
+        used.add(newp)
         ret.append(newp)
     return ret
 
 
-def generate_series_list(commit_range, suffix):
+# Return the list with the name of the patch file for each commit in
+# @commit_range (or just the name for a single commit). If @with_commits is
+# True, a tuple with the list of commits and the list of names is returned
+def generate_series_list(commit_range, suffix, with_commits=False):
     if ".." in commit_range:
         single_arg = []
     else:
         single_arg = ["-1"]
 
-    out = git(["log", "--format=%f", "--reverse", *single_arg, commit_range]).stdout.strip()
-    series = out.splitlines() if out else []
+    out = git(["log", "--format=%H %f", "--reverse", *single_arg, commit_range]).stdout
+    commits, series = [], []
+    for l in out.splitlines():
+        commit, _, name = l.partition(" ")
+        commits.append(commit)
+        series.append(name)
+
     # truncate name as per output of git-format-patch
     series = [x[0:52] for x in series]
     series = fix_duplicate_patch_names(series)
     # add 0001 and .patch prefix/suffix
     series = [f"0001-{x}{suffix}" for x in series]
 
-    return series if not single_arg else series[0]
+    if single_arg:
+        series = series[0]
+        commits = commits[0]
+
+    return (commits, series) if with_commits else series
 
 
 def rm_patches(dest):
     for entry in os.scandir(dest):
-        if not entry.is_file() or not entry.name.endswith(".patch"):
+        if not entry.name.endswith(".patch") or not entry.is_file():
             continue
 
         try:
@@ -467,65 +501,59 @@ def parse_commit_range(commit_range, pile_dir, default_end):
         range[1] = "HEAD"
     base, result = range
     # sanity checks
-    try:
-        git(f"rev-parse {base}", stderr=nul_f, stdout=nul_f)
-        git(f"rev-parse {result}", stderr=nul_f, stdout=nul_f)
-    except (ValueError, subprocess.CalledProcessError):
+    if len(git_rev_parse_list([base, result])) != 2:
         fatal(f"Invalid commit range: {commit_range}")
 
     return base, result
 
 
-def copy_sanitized_patch(p, pnew):
-    with open(p, "r") as oldf, open(pnew, "w") as newf:
-        it = iter(oldf)
+def write_sanitized_patch(patch, pnew):
+    # everything before the diff is allowed, as well as any additional patch
+    # context (like stat)
+    start = patch.find("\n---\n")
+    if start >= 0:
+        start = patch.find("\ndiff --git", start)
+    if start < 0:
+        fatal(f"malformed patch {op.basename(pnew)}\n")
+    start += 1
+
+    # hunk header: everything but "index lines" are allowed, except if we are
+    # in a binary patch: in that case the index must be maintained otherwise
+    # it's not possible to reconstruct the branch
+    diffs = patch[start:].split("\ndiff --git ")
+    with open(pnew, "w") as f:
+        f.write(patch[:start])
+        f.write(
+            "\ndiff --git ".join(d if "\nGIT binary patch\n" in d else DIFF_INDEX_LINE_RE.sub("", d, count=1) for d in diffs)
+        )
 
-        # everything before the diff is allowed
-        for l in it:
-            newf.write(l)
-            if l == "---\n":
-                break
-        else:
-            fatal(f"malformed patch {p}\n")
 
-        # any additional patch context (like stat) is allowed
-        for l in it:
-            newf.write(l)
-            if l.startswith("diff --git"):
-                break
-        else:
-            fatal(f"malformed patch {p}\n")
-
-        while True:
-            # hunk header: everything but "index lines" are allowed,
-            # except if we are in a binary patch: in that case the
-            # index must be maintained otherwise it's not possible to
-            # reconstruct the branch
-            hunk_header = []
-            index_line = -1
-            is_binary = False
-            for l in it:
-                hunk_header.append(l)
-                if l.startswith("@@"):
-                    break
-                if l.startswith("GIT binary patch"):
-                    is_binary = True
-                    break
-                if l.startswith("index"):
-                    index_line = len(hunk_header) - 1
-
-            if not is_binary and index_line >= 0:
-                hunk_header.pop(index_line)
+# Split the output of `git format-patch --stdout` for @commits into one patch
+# per commit. Each patch starts with a "From <commit> <date>" line, that is
+# replaced with the zeroed commit as with --zero-commit. The line of each commit
+# is searched right after the start of the previous patch, so a line like that
+# quoted in a commit message can't be mistaken for the start of a patch: a
+# commit can't mention the commits coming after it
+def split_format_patch_stdout(out, commits):
+    # with a leading LF, every "From" line is preceded by one: the empty line
+    # separating the patches or this one for the first patch
+    out = "\n" + out
+    bounds = []
+    pos = 0
+    for commit in commits:
+        pos = out.find(f"\nFrom {commit} Mon Sep 17 00:00:00 2001\n", pos)
+        if pos < 0:
+            fatal(f"could not find the patch for commit {commit}")
+        bounds.append(pos)
+        pos += 1
+    bounds.append(len(out))
 
-            newf.writelines(hunk_header)
+    patches = []
+    for start, end in zip(bounds, bounds[1:]):
+        _, _, patch = out[start + 1 : end].partition("\n")
+        patches.append(f"From {'0' * len(commits[0])} Mon Sep 17 00:00:00 2001\n{patch}")
 
-            for l in it:
-                newf.write(l)
-                if l.startswith("diff --git"):
-                    break
-            else:
-                # EOF, break outer loop
-                break
+    return patches
 
 
 # pre-existent patches are removed, all patches written from commit_range,
@@ -543,38 +571,29 @@ def genpatches(output, base_commit, result_commit):
     #    already exists and workaround it
 
     commit_range = f"{base_commit}..{result_commit}"
-    commit_list = git(f"rev-list --reverse {commit_range}").stdout.strip().split("\n")
-    if not commit_list:
-        fatal(f"No commits in range {commit_range}")
-
-    series = generate_series_list(commit_range, ".patch")
-
-    # Do everything in a temporary directory and once we know it went ok, move
-    # to the final destination - we can use os.rename() since we are creating
-    # the directory and using a subdir as staging
-    with tempfile.TemporaryDirectory() as d:
-        proc = git(
-            [
-                "format-patch",
-                "--no-add-header",
-                "--no-cc",
-                "--subject-prefix=PATCH",
-                "--zero-commit",
-                "--signature=",
-                "-N",
-                "-o",
-                d,
-                commit_range,
-            ]
-        )
-
-        patches = proc.stdout.strip().splitlines()
-
-        os.makedirs(output, exist_ok=True)
-        rm_patches(output)
-
-        for pold, pnew in zip(patches, series):
-            copy_sanitized_patch(pold, op.join(output, pnew))
+    commits, series = generate_series_list(commit_range, ".patch", with_commits=True)
+
+    # Get all the patches at once and write them directly to the final
+    # destination after sanitizing them
+    proc = git(
+        [
+            "format-patch",
+            "--stdout",
+            "--no-add-header",
+            "--no-cc",
+            "--subject-prefix=PATCH",
+            "--signature=",
+            "-N",
+            commit_range,
+        ]
+    )
+    patches = split_format_patch_stdout(proc.stdout, commits)
+
+    os.makedirs(output, exist_ok=True)
+    rm_patches(output)
+
+    for patch, pnew in zip(patches, series):
+        write_sanitized_patch(patch, op.join(output, pnew))
 
     update_series(output, series)
     update_baseline(output, base_commit)
@@ -595,8 +614,7 @@ def get_cover_letter_message(commit_with_message, file_with_message, signoff):
         body = "*** BLURB HERE ***"
 
     if signoff:
-        user = git("config --get user.name").stdout.strip()
-        email = git("config --get user.email").stdout.strip()
+        user, email = git_user_name_email()
         signoff_str = f"Signed-off-by: {user} <{email}>"
         if signoff_str not in body:
             body += f"\n\n{signoff_str}"
@@ -617,8 +635,7 @@ def gen_cover_letter(
     subject,
     body,
 ):
-    user = git("config --get user.name").stdout.strip()
-    email = git("config --get user.email").stdout.strip()
+    user, email = git_user_name_email()
     # RFC 2822-compliant date format
     now = strftime("%a, %d %b %Y %T %z")
 
@@ -627,9 +644,8 @@ def gen_cover_letter(
         cover_fn = f"{reroll_count_str}-{cover_fn}"
     cover_path = op.join(output_dir, cover_fn)
 
-    # 1:  34cf518f0aab ! 1:  3a4e12046539 <commit message>
     # Let only the lines with state == !, < or >
-    reduced_range_diff = "\n".join(list(filter(lambda x: x and x.split(maxsplit=3)[2] in "!><", range_diff_commits)))
+    reduced_range_diff = "\n".join(m[0] for m in RANGE_DIFF_LINE_RE.finditer(range_diff_commits) if m[2] in "!><")
     zero_fill = int(log10_or_zero(n_patches)) + 1
     if add_header:
         add_header = f"\n{add_header}"
@@ -653,9 +669,7 @@ range-diff:
 
 """
         )
-        for l in diff:
-            f.write(l)
-
+        f.write(diff)
         f.write("--\ngit-pile {version}\n\n".format(version=__version__))
 
     print(cover_path)
@@ -664,8 +678,7 @@ range-diff:
 
 
 def gen_full_tree_patch(output_dir, reroll_count_str, n_patches, oldref, newref, subject_prefix, add_header):
-    user = git("config --get user.name").stdout.strip()
-    email = git("config --get user.email").stdout.strip()
+    user, email = git_user_name_email()
     # RFC 2822-compliant date format
     now = strftime("%a, %d %b %Y %T %z")
 
@@ -705,7 +718,12 @@ def gen_individual_patches(output_dir, reroll_count_str, n_patches, subject_pref
     zero_fill = int(log10_or_zero(n_patches)) + 1
     patches = []
 
+    name_prefix = f"{reroll_count_str}-" if reroll_count_str else ""
+
     with tempfile.TemporaryDirectory() as d:
+        # format-patch outputs "<d>/0001-<name>.patch": skip the dir and number
+        name_offset = len(d) + 1 + 5
+
         for i, c in enumerate(a_commits):
             format_cmd = ["format-patch", "--subject-prefix=PATCH", "--zero-commit", "--signature="]
             if add_header:
@@ -713,9 +731,7 @@ def gen_individual_patches(output_dir, reroll_count_str, n_patches, subject_pref
             format_cmd.extend(["-o", d, "-N", "-1", c[1]])
 
             old = git(format_cmd).stdout.strip()
-            new = op.join(
-                output_dir, "%s%04d-%s" % (f"{reroll_count_str}-" if reroll_count_str else "", i + 1, old[len(d) + 1 + 5 :])
-            )
+            new = op.join(output_dir, f"{name_prefix}{i + 1:04d}-{old[name_offset:]}")
 
             # Copy patches to the final output direcory fixing the Subject
             # lines to conform with the patch order and prefix
@@ -739,8 +755,9 @@ def gen_individual_patches(output_dir, reroll_count_str, n_patches, subject_pref
                 else:
                     fatal(f"patch '{old}' missing subject?")
 
-                # write all the other lines after Subject header at once
-                newf.writelines(oldf.readlines())
+                # copy all the other lines after Subject header in bulk, without
+                # splitting them
+                shutil.copyfileobj(oldf, newf)
 
             print(new)
             patches.append(new)
@@ -837,6 +854,10 @@ class PileCover:
         self.pile_commit = pile_commit
 
     def parse(fname):
+        # only needed for `git pile am`: don't slow down the startup of every
+        # other command by importing it at the top
+        import email
+
         if fname is None:
             oldf = sys.stdin.buffer
         else:
@@ -847,21 +868,17 @@ class PileCover:
 
         # look-ahead on first line and fix up if needed
         l0 = oldf.readline()
-        f = tempfile.NamedTemporaryFile("wb+")
-        if l0.startswith(b"From "):
-            f.write(l0)
-        else:
-            f.write(b"From 0000000000000000000000000000000000000000 Mon Sep 17 00:00:00 2001\n")
-            f.write(l0)
+        if not l0.startswith(b"From "):
+            l0 = b"From 0000000000000000000000000000000000000000 Mon Sep 17 00:00:00 2001\n" + l0
 
-        f.write(oldf.read())
+        # The cover letter is parsed straight from memory: no need to copy it
+        # to a temporary file
+        data = l0 + oldf.read()
 
         if oldf != sys.stdin.buffer:
             oldf.close()
 
-        f.seek(0)
-
-        m = email.message_from_binary_file(f)
+        m = email.message_from_bytes(data)
         if not m:
             error(f'No patches in \'{fname if fname else "stdin"}\'')
             return None
@@ -891,7 +908,7 @@ class PileCover:
         pile_commit = None
 
         for idx, l in enumerate(body_list[start:]):
-            if l.startswith("diff") or l.startswith("range-diff"):
+            if l.startswith(("diff", "range-diff")):
                 break
 
             elems = l.split(": ")
@@ -912,6 +929,8 @@ class PileCover:
         return PileCover(m, version, baseline, pile_commit)
 
     def dump(self, f):
+        import email.header
+
         from_str = self.m.get_unixfrom() or "0000000000000000000000000000000000000000 Mon Sep 17 00:00:00 2001"
         f.write(f"From {from_str}\n")
 
@@ -950,18 +969,14 @@ def should_try_fuzzy(args, msg):
 
 
 def git_am_solve_diff_hunk_conflicts(args, patchesdir):
-    status = git(f"-C {patchesdir} status --porcelain").stdout.splitlines()
+    # classify the status entries only once: unmerged ones have an "U" in
+    # either side
+    unmerged = [l for l in git(f"-C {patchesdir} status --porcelain").stdout.splitlines() if "U" in l[:2]]
     resolved = True
-    any_unmerged = False
 
     # double check we are actually resolving unmerged, we could have failed due
     # to other reasons
-    for l in status:
-        if l[0] == "U" or l[1] == "U":
-            any_unmerged = True
-            break
-
-    if not any_unmerged:
+    if not unmerged:
         return False
 
     warn("git-pile am failed")
@@ -970,13 +985,9 @@ def git_am_solve_diff_hunk_conflicts(args, patchesdir):
 
     warn("Trying to fix conflicts automatically")
 
-    sed = run_wrapper("sed", capture=True)
-
     # solve UU conflicts only, we don't really know how to resolve the others
-    for f in status:
-        if f[0] != "U" and f[1] != "U":
-            continue
-        if (f[0] == "U") ^ (f[1] == "U"):
+    for f in unmerged:
+        if f[0] != f[1]:
             resolved = False
             continue
 
@@ -984,17 +995,14 @@ def git_am_solve_diff_hunk_conflicts(args, patchesdir):
         path = op.join(patchesdir, f)
 
         print(f"Trying to fix conflicts in {f}... ", end="", file=sys.stderr)
-        sed(["-i", "-e", "/^<<<<<<< HEAD/ {N;N;N;N; s/<<<<<<< HEAD.*\\n@@.*\\n=======.*\\n\\(@@.*\\)\\n>>>>>>>.*/\\1/g}", path])
+        with open(path, "rb") as fp:
+            content = fp.read()
+        content = DIFF_HUNK_CONFLICT_RE.sub(rb"\1", content)
+        with open(path, "wb") as fp:
+            fp.write(content)
 
         # Check with all markers are gone
-        any_markers = False
-        with open(path) as fp:
-            for l in fp:
-                if l.startswith("<<<<<<< HEAD"):
-                    any_markers = True
-                    break
-
-        if any_markers:
+        if CONFLICT_MARKER_RE.search(content):
             resolved = False
             print("fail: couldn't solve all conflicts, some of them left behind", file=sys.stderr)
         else:
@@ -1124,6 +1132,27 @@ See the help of this command for extra details"""
         )
 
 
+# Resolve each of @refs to a single sha1, aborting if any of them is invalid
+# or expands to more than one revision (e.g. a range). All of them are resolved
+# with a single git-rev-parse call, checking one by one only to report an
+# error. @labels, if given, is what to name in the error for each ref, with
+# @kind being what it should point to.
+def _rev_parse_single_revs(refs, labels=None, kind="ref"):
+    revs = git_rev_parse_list(refs)
+    # a negative revision can only come from a ref expanding to a range
+    if len(revs) == len(refs) and not any(r.startswith("^") for r in revs):
+        return revs
+
+    for ref, label in zip(refs, labels or refs):
+        n_revs = len(git_rev_parse_list([ref]))
+        if n_revs == 0:
+            fatal(f"{label} does not point to a valid {kind}")
+        if n_revs > 1:
+            fatal(f"'{ref}' expands to {n_revs} revisions, but a single ref is expected")
+
+    fatal("could not parse refs:", *refs)
+
+
 # Parse refs from command line
 #    branch  (branch@{u} is implicitly used)
 #    ref1...ref2
@@ -1160,25 +1189,9 @@ def _parse_format_refs(refs, current_baseline):
         r1 = refs[0].split("..")
         r2 = refs[1].split("..")
         if len(r1) == len(r2) and len(r1) == 2:
-            oldbaseline = None
-            oldref = None
-            try:
-                oldbaseline = git(f"rev-parse {r1[0]}", stderr=nul_f).stdout.strip()
-                oldref = git(f"rev-parse {r1[1]}", stderr=nul_f).stdout.strip()
-                newbaseline = git(f"rev-parse {r2[0]}", stderr=nul_f).stdout.strip()
-                newref = git(f"rev-parse {r2[1]}", stderr=nul_f).stdout.strip()
-            except subprocess.CalledProcessError:
-                if not oldbaseline or not oldref:
-                    fatal(f"{r1} does not point to a valid range")
-                fatal(f"{r2} does not point to a valid range")
+            oldbaseline, oldref, newbaseline, newref = _rev_parse_single_revs(r1 + r2, [r1, r1, r2, r2], "range")
         else:
-            try:
-                oldref = git(f"rev-parse {refs[0]}", stderr=nul_f).stdout.strip()
-                newref = git(f"rev-parse {refs[1]}", stderr=nul_f).stdout.strip()
-            except subprocess.CalledProcessError:
-                if not oldref:
-                    fatal(f"{refs[0]} does not point to a valid ref")
-                fatal(f"{refs[1]} does not point to a valid ref")
+            oldref, newref = _rev_parse_single_revs(refs)
     else:
         fatal("could not parse refs:", *refs)
 
@@ -1210,15 +1223,12 @@ def _parse_range_diff(range_diff_commits):
     a_commits = []
     d_commits = []
 
-    # we maintain the position of each commit in the new branch so we can sort
-    # them later
+    # we maintain the position of each commit in the new branch. Entries are
+    # visited in that order, so the lists come out already sorted by it
     n = 1
 
-    for c in range_diff_commits:
-        if not c:
-            continue
-
-        _, old_sha1, s, _, new_sha1, _ = c.split(maxsplit=5)
+    for m in RANGE_DIFF_LINE_RE.finditer(range_diff_commits):
+        old_sha1, s, new_sha1 = m.groups()
         if s == "!":
             c_commits += [(old_sha1, new_sha1, n)]
         elif s == ">":
@@ -1228,13 +1238,24 @@ def _parse_range_diff(range_diff_commits):
 
         n += 1
 
+    revs = [x[0] for x in c_commits]
+    revs += [x[1] for x in c_commits]
+    revs += [x[1] for x in a_commits]
+    revs += [x[0] for x in d_commits]
+    revs = list(orderedset(revs))
+
+    # Get the patch names for all the commits with a single git-log call and
+    # index them by sha1. git-log skips duplicate revs, hence the dedup above
+    if revs:
+        names = git(["log", "--no-walk=unsorted", "--format=%f", *revs]).stdout.splitlines()
+    else:
+        names = []
+    patch_names = dict(zip(revs, names))
+
     diff_filter_list = ["config", "series"]
-    diff_filter_list += [generate_series_list(x[0], "*.patch") for x in c_commits]
-    diff_filter_list += [generate_series_list(x[1], "*.patch") for x in c_commits]
-    diff_filter_list += [generate_series_list(x[1], "*.patch") for x in a_commits]
-    diff_filter_list += [generate_series_list(x[0], "*.patch") for x in d_commits]
+    # truncate name as per output of git-format-patch, like generate_series_list()
+    diff_filter_list += [f"0001-{patch_names[x][0:52]}*.patch" for x in revs]
     diff_filter_list = list(orderedset(diff_filter_list))
-    a_commits.sort(key=lambda x: x[2])
 
     return c_commits, a_commits, d_commits, diff_filter_list
 
@@ -1405,7 +1426,7 @@ option to this command."""
         range_diff_new_empty = git(["rev-list", "--count", range_diff_new]).stdout.strip() == "0"
 
         if range_diff_old_empty and range_diff_new_empty:
-            range_diff_commits = []
+            range_diff_commits = ""
         else:
             # git range-diff breaks if one of the ranges are empty, so we need
             # the workaround below to make it work.
@@ -1419,7 +1440,7 @@ option to this command."""
             creation_factor = f"--creation-factor={args.creation_factor}" if args.creation_factor else ""
             range_diff_commits = git(
                 f"range-diff --no-color --no-patch {creation_factor} {range_diff_old} {range_diff_new}"
-            ).stdout.split("\n")
+            ).stdout
 
         c_commits, a_commits, d_commits, diff_filter_list = _parse_range_diff(range_diff_commits)
 
@@ -1434,11 +1455,7 @@ option to this command."""
                 return 1
 
             git("-C %s add --force -A" % tmpdir)
-            with tempfile.NamedTemporaryFile("w+") as order_file:
-                for l in diff_filter_list:
-                    order_file.write(l + "\n")
-                order_file.flush()
-
+            with child_input_file("".join(f"{l}\n" for l in diff_filter_list)) as (order_file, pass_fds):
                 diff = git(
                     [
                         "-C",
@@ -1448,11 +1465,13 @@ option to this command."""
                         "-p",
                         "--stat",
                         "-O",
-                        order_file.name,
+                        order_file,
                         "--no-ext-diff",
                         "--",
                         *diff_filter_list,
-                    ]
+                    ],
+                    pass_fds=pass_fds,
+                    close_fds=True,
                 ).stdout
                 if not diff:
                     fatal(f"Nothing changed from {oldbaseline}..{config.result_branch} to {newbaseline}..{newref}")
@@ -1525,6 +1544,22 @@ option to this command."""
         return 0
 
 
+# Iterate over the NUL-terminated records in the binary stream @f, as output by
+# git commands with -z, without waiting for the whole output
+def _read_nul_terminated(f, bufsize=65536):
+    pending = b""
+    while True:
+        chunk = f.read1(bufsize)
+        if not chunk:
+            break
+
+        *records, pending = (pending + chunk).split(b"\x00")
+        yield from records
+
+    if pending:
+        yield pending
+
+
 # returns (top_linear_ref, refspec)
 # - top_linear_ref is the the latest ref from the linearized branch if we have one
 # - refspec is something suitable to pass to rev-list/log to get the missing
@@ -1541,26 +1576,37 @@ def get_refs_from_linearized(incremental, pile_branch, start_ref, linear_branch,
     if not git_ref_exists(f"refs/notes/{linear_branch}"):
         return None, pile_range
 
-    proc = git_can_fail(f"rev-list --no-merges {linear_branch}", stderr=nul_f)
-    if proc.returncode or not proc.stdout:
-        return None, pile_range
-
-    refs = proc.stdout.strip().split("\n")
-    key = "pile-commit: "
-    for ref in refs:
-        notes = git(f"log --notes={notes_ref} --format=%N -1 {ref}").stdout.strip().split("\n")
-        for n in notes:
-            if n.startswith(key):
-                val = n[len(key) :]
+    # Walk the linearized branch with a single git-log that outputs each commit
+    # together with its notes, stopping as soon as we find a commit created by
+    # us. Keep the output as bytes and only decode what we are going to use.
+    cmd = ["log", "-z", "--no-merges", f"--notes={notes_ref}", "--format=%H%n%N", linear_branch]
+    key = b"pile-commit: "
+    top_ref = None
+    val = None
+    with git.popen(cmd, universal_newlines=False, stderr=nul_f) as proc:
+        for record in _read_nul_terminated(proc.stdout):
+            ref, _, notes = record.partition(b"\n")
+            if top_ref is None:
+                top_ref = ref.decode()
+
+            val = next((n[len(key) :].decode() for n in notes.split(b"\n") if n.startswith(key)), None)
+            if val:
+                break
+        else:
+            # all the output was consumed, so git didn't die because we stopped
+            # reading: any error is real and not the same as finding no note
+            if proc.wait() != 0:
+                fatal(f"could not read the commits and notes of '{linear_branch}'")
 
-                # ensure we are starting at a ref newer than the start point
-                if start_ref and not git_ref_is_ancestor(start_ref, val):
-                    error(f"Provided start-ref {start_ref} is not ancestor of commit in git-notes ({val})")
-                    return None, None
+    if not val:
+        return None, pile_range
 
-                return refs[0], f"{val}..{pile_branch}"
+    # ensure we are starting at a ref newer than the start point
+    if start_ref and not git_ref_is_ancestor(start_ref, val):
+        error(f"Provided start-ref {start_ref} is not ancestor of commit in git-notes ({val})")
+        return None, None
 
-    return None, pile_range
+    return top_ref, f"{val}..{pile_branch}"
 
 
 class GenlinearBranchCmd(PileCommand):
@@ -1639,7 +1685,7 @@ class GenlinearBranchCmd(PileCommand):
             # exist. In that case, just checkout anything, we are going to reset
             # to a new commit as the first thing anyway
             commit = Pile(path=piledir).baseline() or refs[0]
-            with git_temporary_worktree(commit, config.root) as resultdir:
+            with git_temporary_worktree(commit, config.root) as resultdir, git_cat_file_batch() as cat_file:
                 last_good_ref = None
                 tree = "tree " + git(f"log --format=%T -1 {parent_ref}").stdout.strip() if parent_ref else None
 
@@ -1655,7 +1701,10 @@ class GenlinearBranchCmd(PileCommand):
                     pre_genbranch_exec = run_wrapper(args.pre_genbranch_exec, shell=True)
                 if args.post_genbranch_exec:
                     post_genbranch_exec = run_wrapper(args.post_genbranch_exec, shell=True)
-                hook_env = {**os.environ, "PILE_DIR": piledir, "RESULT_DIR": resultdir}
+                # only pay for copying the environment if there's a hook to run
+                hook_env = None
+                if pre_genbranch_exec or post_genbranch_exec:
+                    hook_env = {**os.environ, "PILE_DIR": piledir, "RESULT_DIR": resultdir}
 
                 for idx, rev in enumerate(refs):
                     git(f"-C {piledir} reset --hard {rev}")
@@ -1707,11 +1756,12 @@ class GenlinearBranchCmd(PileCommand):
                     if parent_ref:
                         commit_input += [f"parent {parent_ref}"]
 
-                    out = git(f"cat-file commit {rev}").stdout.strip().split("\n")
+                    _, out = cat_file(rev)
+                    out = out.decode().strip().split("\n")
                     for idx, l in enumerate(out):
                         if not l:
                             break
-                        if l.startswith("tree") or l.startswith("parent"):
+                        if l.startswith(("tree", "parent")):
                             continue
                         commit_input += [l]
                     commit_input += out[idx:]
@@ -1882,6 +1932,9 @@ class ResetCmd(PileCommand):
 
 def parse_args(cli, cmd_args):
     try:
+        if "_ARGCOMPLETE" in os.environ:
+            # completion needs to know the arguments of all commands
+            cli.init_commands()
         argcomplete.autocomplete(cli.parser)
     except NameError:
         pass
@@ -6,14 +6,17 @@ Common git utilities.
 import contextlib
 import os
 import os.path as op
+import re
 import subprocess
 import sys
 import tempfile
 
 from .helpers import (
+    cached_git_query,
     git,
     git_can_fail,
     nul_f,
+    warn,
 )
 
 
@@ -21,6 +24,42 @@ def git_branch_exists(branch):
     return git(f"show-ref --verify --quiet refs/heads/{branch}", check=False).returncode == 0
 
 
+# Start a long-running git-cat-file process to read many objects while paying
+# for the process startup only once. Yields a function that receives a rev and
+# returns its object type and contents (as bytes), or (None, None) if the object
+# doesn't exist. If @contents is False, only the existence and type of objects
+# are checked (with --batch-check) and the contents returned are always None.
+#
+# To be used in `with` context handling.
+@contextlib.contextmanager
+def git_cat_file_batch(path=".", contents=True):
+    mode = "--batch" if contents else "--batch-check"
+    with subprocess.Popen(
+        ["git", "-C", path, "cat-file", mode], stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=False
+    ) as proc:
+
+        def cat_file(rev):
+            proc.stdin.write(f"{rev}\n".encode())
+            proc.stdin.flush()
+
+            header = proc.stdout.readline().split()
+            if len(header) != 3:
+                # "<rev> missing" or "<rev> ambiguous"
+                return None, None
+
+            _, objecttype, size = header
+            if not contents:
+                return objecttype.decode(), None
+
+            data = proc.stdout.read(int(size))
+            # contents are followed by a LF
+            proc.stdout.read(1)
+
+            return objecttype.decode(), data
+
+        yield cat_file
+
+
 # Mimic git bevavior to find the editor. We need to do this since
 # GIT_EDITOR was overriden
 def git_get_editor():
@@ -42,6 +81,12 @@ def git_init(branch, directory):
     git(f"-C {directory} checkout -b {branch}")
 
 
+# Return the name of the hash algorithm used for object names in the repository
+@cached_git_query
+def git_object_format():
+    return git_can_fail("config --get extensions.objectFormat", stderr=nul_f).stdout.strip().lower() or "sha1"
+
+
 def git_ref_exists(ref):
     return git(f"show-ref --verify --quiet {ref}", check=False).returncode == 0
 
@@ -50,11 +95,102 @@ def git_ref_is_ancestor(ancestor, ref):
     return git_can_fail(f"merge-base --is-ancestor {ancestor} {ref}").returncode == 0
 
 
-def git_remote_branch_exists(remote_and_branch):
-    return git(f"show-ref --verify --quiet refs/remotes/{remote_and_branch}", check=False).returncode == 0
+# Return a dict mapping the full name of each ref matching @patterns (as
+# accepted by git-for-each-ref) to the sha1 it points to. Checking many refs
+# against it is cheaper than calling git_ref_exists() for each of them
+def git_refs(patterns):
+    out = git(["for-each-ref", "--format=%(refname) %(objectname)", *patterns]).stdout
+    return dict(l.split(" ", 1) for l in out.splitlines())
+
+
+# Check out @commit in a worktree at @name (relative to @gitdir) that is kept
+# around after use, so that later calls only need to update the files that
+# changed instead of populating a new worktree from scratch. The worktree is
+# created if it doesn't exist yet. Access is serialized with a
+# "git-pile-<worktree>.flock" file next to the worktree, which is left in place:
+# removing it would race with another process about to lock it.
+#
+# None is yielded if the worktree can't be used, and the caller needs to fall
+# back to something else (e.g. git_temporary_worktree()): if another process is
+# using it, if it can't be created or if @name points to a place where the
+# worktree would clobber the user's work or git's own files, i.e. outside
+# @gitdir, over an existing entry of @gitdir, the main worktree or any worktree
+# with a branch checked out.
+#
+# To be used in `with` context handling.
+@contextlib.contextmanager
+def git_reusable_worktree(commit, gitdir, name):
+    # only needed for this opt-in feature: don't make the whole module depend
+    # on it being available
+    import fcntl
+
+    gitdir = op.realpath(gitdir)
+    path = op.realpath(op.join(gitdir, name))
+    if path == gitdir or op.commonpath([gitdir, path]) != gitdir:
+        warn(f"not using '{path}' as worktree: it is not inside '{gitdir}'")
+        yield None
+        return
+
+    # worktree path -> branch checked out in it, the first one being the main
+    # worktree
+    worktrees = {}
+    for l in git(["worktree", "list", "--porcelain"]).stdout.splitlines():
+        if l.startswith("worktree "):
+            worktree = op.realpath(l[9:])
+            worktrees[worktree] = None
+        elif l.startswith("branch "):
+            worktrees[worktree] = l[7:]
+
+    if path in worktrees and (path == next(iter(worktrees)) or worktrees[path]):
+        warn(f"not using '{path}' as worktree: it is a worktree in use")
+        yield None
+        return
+
+    if path in worktrees and not op.isdir(path):
+        # our worktree is gone: forget about it so it's created again
+        git(["worktree", "remove", "--force", path])
+        del worktrees[path]
+
+    if path not in worktrees:
+        top = op.join(gitdir, op.relpath(path, gitdir).split(op.sep)[0])
+        if op.lexists(top):
+            warn(f"not using '{path}' as worktree: '{top}' already exists")
+            yield None
+            return
+
+    os.makedirs(op.dirname(path), exist_ok=True)
+    lock_path = op.join(op.dirname(path), f"git-pile-{op.basename(path)}.flock")
+    with open(lock_path, "w") as lock_f:
+        try:
+            fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield None
+            return
+
+        if path in worktrees:
+            # drop anything left behind by a previous run that failed midway
+            if op.exists(op.join(git_worktree_get_git_dir(path), "rebase-apply")):
+                git(["-C", path, "am", "--abort"], stdout=nul_f, stderr=nul_f)
+            git(["-C", path, "reset", "--hard", "-q", commit])
+            git(["-C", path, "clean", "-fdxq"])
+        else:
+            add_cmd = ["worktree", "add", "--detach", "--checkout", path, commit]
+            if git_can_fail(add_cmd, stdout=nul_f, stderr=nul_f).returncode != 0:
+                path = None
+
+        yield path
+
+
+# Resolve all @revs with a single git-rev-parse call. git stops parsing
+# revisions on the first argument that is not one, so the returned list of
+# sha1s is shorter than @revs in that case: its length is the index of the
+# first invalid revision
+def git_rev_parse_list(revs):
+    return git(["rev-parse", "--revs-only", *revs], stderr=nul_f).stdout.split()
 
 
 # Return the git root of current worktree or abort when not in a worktree
+@cached_git_query
 def git_root_or_die():
     try:
         return git("rev-parse --show-toplevel").stdout.strip("\n")
@@ -65,12 +201,12 @@ def git_root_or_die():
 @contextlib.contextmanager
 def git_split_index(path="."):
     if git_worktree_config_extension_enabled():
-        config_cmd = "config --worktree"
+        config_cmd = ("config", "--worktree")
     else:
-        config_cmd = "config"
+        config_cmd = ("config",)
 
     # only change if not explicitely configure in config
-    change_split_index = git_can_fail(f"-C {path} {config_cmd} --get core.splitIndex").returncode != 0
+    change_split_index = git_can_fail(["-C", path, *config_cmd, "--get", "core.splitIndex"]).returncode != 0
 
     if not change_split_index:
         try:
@@ -78,18 +214,18 @@ def git_split_index(path="."):
         finally:
             return
 
-    change_shared_index_expire = git_can_fail(f"-C {path} {config_cmd} --get splitIndex.sharedIndexExpire").returncode != 0
+    change_shared_index_expire = git_can_fail(["-C", path, *config_cmd, "--get", "splitIndex.sharedIndexExpire"]).returncode != 0
 
     try:
-        git(f"-C {path} update-index --split-index")
+        git(["-C", path, "update-index", "--split-index"])
         if change_shared_index_expire:
-            git(f"-C {path} {config_cmd} splitIndex.sharedIndexExpire now")
+            git(["-C", path, *config_cmd, "splitIndex.sharedIndexExpire", "now"])
 
         yield
     finally:
-        git(f"-C {path} update-index --no-split-index")
+        git(["-C", path, "update-index", "--no-split-index"])
         if change_shared_index_expire:
-            git(f"-C {path} {config_cmd} --unset splitIndex.sharedIndexExpire")
+            git(["-C", path, *config_cmd, "--unset", "splitIndex.sharedIndexExpire"])
 
 
 # Create a temporary directory to checkout a detached branch with git-worktree
@@ -104,12 +240,28 @@ def git_temporary_worktree(commit, dir, prefix="git-pile-worktree"):
 
     try:
         with tempfile.TemporaryDirectory(dir=dir, prefix=prefix) as d:
-            git(f"worktree add --detach --checkout {d} {commit}", stdout=nul_f, stderr=nul_f)
+            git(["worktree", "add", "--detach", "--checkout", d, commit], stdout=nul_f, stderr=nul_f)
             yield d
     finally:
-        git(f"worktree remove {d}")
+        git(["worktree", "remove", d])
+
 
+# Return a (name, email) tuple from the user.name and user.email configuration,
+# read with a single git-config call. Missing values are returned as ""
+@cached_git_query
+def git_user_name_email():
+    values = {"user.name": "", "user.email": ""}
+    out = git_can_fail(["config", "-z", "--get-regexp", r"^user\.(name|email)$"], stderr=nul_f).stdout
+    for kv in out.split("\0"):
+        key, _, value = kv.partition("\n")
+        # like `git config --get`, the last value wins
+        if key in values:
+            values[key] = value
 
+    return values["user.name"], values["user.email"]
+
+
+@cached_git_query
 def git_worktree_config_extension_enabled():
     return git_can_fail("config --get --bool extensions.worktreeConfig", stderr=nul_f).stdout.strip() == "true"
 
@@ -117,34 +269,25 @@ def git_worktree_config_extension_enabled():
 # Return the path a certain branch is checked out at
 # or None.
 def git_worktree_get_checkout_path(root, branch):
-    state = dict()
-    out = git(f"-C {root} worktree list --porcelain").stdout.split("\n")
-    path = None
-
-    for l in out:
-        if not l:
-            # end block
-            if state.get("branch", None) == "refs/heads/" + branch:
-                path = op.realpath(state["worktree"])
-                break
-
-            state = dict()
-            continue
-
-        v = l.split(" ")
-        state[v[0]] = v[1] if len(v) > 1 else None
+    wanted = f"branch refs/heads/{branch}"
+    worktree = None
 
-    # make sure `git worktree list` is in sync with reality
-    if not path or not op.isdir(path):
-        return None
+    for l in git(["-C", root, "worktree", "list", "--porcelain"]).stdout.splitlines():
+        if l.startswith("worktree "):
+            worktree = l[9:]
+        elif l == wanted:
+            path = op.realpath(worktree)
+            # make sure `git worktree list` is in sync with reality
+            return path if op.isdir(path) else None
 
-    return path
+    return None
 
 
 # Get the git dir (aka .git) directory for the worktree related to
 # the @path. @path defaults to CWD
+@cached_git_query
 def git_worktree_get_git_dir(path=".", force_absolute=False):
-    gitdir = git(f"-C {path} rev-parse --git-dir").stdout.strip("\n")
+    gitdir = git(["-C", path, "rev-parse", "--git-dir"]).stdout.strip("\n")
     if force_absolute:
         # Manpage for git-rev-parse says the following about the --git-dir
         # option: "The path shown, when relative, is relative to the current
@@ -158,7 +301,27 @@ def git_worktree_get_git_dir(path=".", force_absolute=False):
     return gitdir
 
 
+# Return the commit checked out in the worktree at @path. A detached HEAD (as
+# in the worktrees created by git-pile) is read directly from the HEAD file,
+# without spawning git; anything else is resolved with git-rev-parse.
+def git_worktree_head(path):
+    try:
+        gitdir = op.join(path, ".git")
+        if op.isfile(gitdir):
+            with open(gitdir) as f:
+                gitdir = op.join(path, f.read().strip().partition("gitdir: ")[2])
+        with open(op.join(gitdir, "HEAD")) as f:
+            head = f.read().strip()
+    except OSError:
+        head = ""
+
+    if not re.fullmatch(r"[0-9a-f]{40}|[0-9a-f]{64}", head):
+        head = git(["-C", path, "rev-parse", "HEAD"]).stdout.strip()
+
+    return head
+
+
 def git_worktree_list(root):
-    out = git(f"-C {root} worktree list --porcelain").stdout.splitlines()
+    out = git(["-C", root, "worktree", "list", "--porcelain"]).stdout.splitlines()
     ret = tuple(op.realpath(s.split(maxsplit=1)[1]) for s in out if s.startswith("worktree"))
     return ret
@@ -1,10 +1,12 @@
 #!/usr/bin/python3
 # SPDX-License-Identifier: LGPL-2.1+
 
+import functools
 import os
 import shlex
 import subprocess
 import sys
+import tempfile
 from contextlib import contextmanager
 
 debug_run = False
@@ -63,24 +65,36 @@ class run_wrapper:
         self.check = check
         self.print_error_as_ignored = print_error_as_ignored
         self.shell = shell
+        # arguments to subprocess.run() are the same for most calls, so build
+        # them only once
+        self.default_kwargs = self._default_kwargs(capture, print_error_as_ignored)
+
+    def _default_kwargs(self, capture, print_error_as_ignored):
+        # File descriptors opened by python are non-inheritable by default,
+        # so there's no need to close them on the child. Not doing so allows
+        # subprocess to use posix_spawn() rather than fork() + exec()
+        kwargs = {"check": self.check, "shell": self.shell, "close_fds": False}
+
+        if capture:
+            kwargs["stdout"] = subprocess.PIPE
+            kwargs["universal_newlines"] = True
+
+        if print_error_as_ignored:
+            kwargs["universal_newlines"] = True
+
+        return kwargs
 
     def __call__(self, s, *args, **kwargs):
         capture = kwargs.pop("capture", self.capture)
         print_error_as_ignored = kwargs.pop("print_error_as_ignored", self.print_error_as_ignored)
 
-        if capture:
-            if "stdout" not in kwargs:
-                kwargs["stdout"] = subprocess.PIPE
-            if "universal_newlines" not in kwargs:
-                kwargs["universal_newlines"] = True
+        if capture == self.capture and print_error_as_ignored == self.print_error_as_ignored:
+            kwargs = {**self.default_kwargs, **kwargs}
+        else:
+            kwargs = {**self._default_kwargs(capture, print_error_as_ignored), **kwargs}
 
         if print_error_as_ignored:
             kwargs["stderr"] = subprocess.PIPE
-            if "universal_newlines" not in kwargs:
-                kwargs["universal_newlines"] = True
-
-        kwargs["check"] = kwargs.get("check", self.check)
-        kwargs["shell"] = kwargs.get("shell", self.shell)
 
         cmd, cmd_debug = self._assemble_cmd(s)
 
@@ -95,6 +109,22 @@ class run_wrapper:
 
         return ret
 
+    def popen(self, s, *args, **kwargs):
+        """
+        Like calling the wrapper, but start the command with subprocess.Popen()
+        and return right away, so its output can be consumed as it's produced.
+        "check" doesn't apply: the caller needs to check the return code.
+        """
+        kwargs = {**self.default_kwargs, **kwargs}
+        del kwargs["check"]
+
+        cmd, cmd_debug = self._assemble_cmd(s)
+
+        if debug_run:
+            print("+ " + cmd_debug, file=sys.stderr)
+
+        return subprocess.Popen(cmd, *args, **kwargs)
+
     def _assemble_cmd(self, tail):
         if self.shell:
             cmd = self.cmd + " " + tail
@@ -172,6 +202,22 @@ def warn(s, *args, **kwargs):
     print_color(color, "warning:", s, *args, **kwargs)
 
 
+# Decorator to cache the result of @f, a function doing a read-only git query
+# whose answer doesn't change while git-pile is running. Since git is called
+# relative to the current directory, that is also part of the cache key.
+def cached_git_query(f):
+    @functools.lru_cache(maxsize=None)
+    def cached(cwd, *args, **kwargs):
+        return f(*args, **kwargs)
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        return cached(os.getcwd(), *args, **kwargs)
+
+    wrapper.cache_clear = cached.cache_clear
+    return wrapper
+
+
 def orderedset(it):
     return dict.fromkeys(it).keys()
 
@@ -199,6 +245,30 @@ def prompt_yesno(question, default):
     return default
 
 
+# Yield a (path, pass_fds) tuple for a file with @contents, to be passed to child
+# processes. Where possible the file only lives in memory, created with
+# memfd_create() and accessed by the children through /proc/self/fd: the
+# children can only open it if they get the file descriptor, so the command
+# must be run with pass_fds=pass_fds. Otherwise a temporary file is used and
+# pass_fds is empty.
+@contextmanager
+def child_input_file(contents):
+    if not hasattr(os, "memfd_create") or not os.path.isdir("/proc/self/fd"):
+        with tempfile.NamedTemporaryFile("w+") as f:
+            f.write(contents)
+            f.flush()
+            yield f.name, ()
+        return
+
+    fd = os.memfd_create("git-pile", 0)
+    try:
+        with open(fd, "w", closefd=False) as f:
+            f.write(contents)
+        yield f"/proc/self/fd/{fd}", (fd,)
+    finally:
+        os.close(fd)
+
+
 @contextmanager
 def pushdir(d, oldd):
     if not oldd:
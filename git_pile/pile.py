@@ -22,12 +22,15 @@ branch" will be used to refer to the required structure, abstracting away
 whether it comes from a git tree-ish object or directory in the file system.
 """
 import abc
-import collections
+import hashlib
 import pathlib
 import subprocess
 
+from .gitutil import git_object_format
 from .helpers import (
     git,
+    git_can_fail,
+    nul_f,
     warn,
 )
 
@@ -69,6 +72,7 @@ class Pile:
         self.__path = path
         self.__reader = _RevReader(rev, rev_repo_path) if rev else _PathReader(path)
         self.__config = None
+        self.__series = None
         self.__baseline_override = baseline
 
     def validate_structure(self, warn_non_patches=True):
@@ -136,12 +140,16 @@ class Pile:
     def series(self):
         """
         Yield a PilePatch object for each patch found in the pile series.
+
+        Note that the series is cached for subsequent calls, which yield the
+        same PilePatch objects, so that their sha-1 digests are computed only
+        once.
         """
-        for line in self.__reader.text("series").splitlines():
-            line = line.strip()
-            if not line or line[0] == "#":
-                continue
-            yield PilePatch(line, self.__reader)
+        if self.__series is None:
+            lines = (line.strip() for line in self.__reader.text("series").splitlines())
+            self.__series = [PilePatch(line, self.__reader) for line in lines if line and line[0] != "#"]
+
+        yield from self.__series
 
     def __loc_phrase(self):
         if self.__rev:
@@ -170,9 +178,12 @@ class PilePatch:
     def __init__(self, name, reader):
         self.name = name
         self.__reader = reader
+        self.__sha1 = None
 
     def sha1(self):
-        return self.__reader.sha1(*pathlib.Path(self.name).parts)
+        if self.__sha1 is None:
+            self.__sha1 = self.__reader.sha1(*pathlib.Path(self.name).parts)
+        return self.__sha1
 
 
 class PileError(Exception):
@@ -224,8 +235,13 @@ class _FileReader(abc.ABC):
 
 
 class _PathReader(_FileReader):
+    # Attributes that make git convert the contents of a file when hashing it
+    CONVERSION_ATTRS = ("text", "eol", "crlf", "filter", "ident", "working-tree-encoding")
+
     def __init__(self, path):
         self.__path = pathlib.Path(path)
+        self.__sha1s = {}
+        self.__convert_all = None
 
     def ls(self, include_type=False):
         for p in self.__filter_git_ignored(self.__path.glob("*")):
@@ -239,13 +255,77 @@ class _PathReader(_FileReader):
         return self.__path.joinpath(*path).read_text()
 
     def sha1(self, *path):
-        return git(["hash-object", "--", str(self.__path.joinpath(*path))]).stdout.strip()
+        name = pathlib.PurePath(*path).as_posix()
+        if name not in self.__sha1s:
+            if not self.__path.joinpath(*path).is_file():
+                raise FileNotFoundError(f"{self.__path.joinpath(*path)}: no such file")
+
+            # hash everything in the directory at once on the first call
+            names = {name}
+            if not self.__sha1s:
+                names.update(n for n, objecttype in self.ls(include_type=True) if objecttype == "blob")
+            self.__sha1s.update(self.__hash_files(sorted(names)))
+
+        return self.__sha1s[name]
+
+    # Return a dict mapping each of @names to the sha1 git would give to it.
+    # Files that git stores as is are hashed in-process. The ones git would
+    # convert when hashing (due to core.autocrlf, filters or attributes like
+    # text and eol) are left to a single git-hash-object call.
+    def __hash_files(self, names):
+        convert = self.__converted_files(names)
+        sha1s = {}
+
+        for name in names:
+            if name in convert:
+                continue
+            data = self.__path.joinpath(name).read_bytes()
+            h = hashlib.new(git_object_format(), b"blob %d\0" % len(data))
+            h.update(data)
+            sha1s[name] = h.hexdigest()
+
+        if convert:
+            out = git(["-C", str(self.__path), "hash-object", "--stdin-paths"], input="\n".join(convert)).stdout
+            sha1s.update(zip(convert, out.split()))
+
+        return sha1s
+
+    # Return the subset of @names that git converts when hashing
+    def __converted_files(self, names):
+        if self.__convert_all is None:
+            config = git_can_fail(
+                ["-C", str(self.__path), "config", "--get-regexp", r"^core\.autocrlf$|^filter\..*\.(clean|process)$"],
+                stderr=nul_f,
+            ).stdout.splitlines()
+            # any filter driver or core.autocrlf other than false
+            self.__convert_all = any(
+                key != "core.autocrlf" or value.lower() not in ("false", "no", "off", "0")
+                for key, _, value in (l.partition(" ") for l in config)
+            )
+
+        if self.__convert_all:
+            return names
+
+        out = git_can_fail(
+            ["-C", str(self.__path), "check-attr", "--stdin", "-z", *self.CONVERSION_ATTRS],
+            input="\x00".join(names),
+            stderr=nul_f,
+        )
+        if out.returncode != 0:
+            # not in a git repository: there are no attributes to apply
+            return []
+
+        # output is a sequence of "<path> NUL <attribute> NUL <info> NUL"
+        fields = out.stdout.split("\x00")
+        return list(dict.fromkeys(n for n, v in zip(fields[0::3], fields[2::3]) if v not in ("unspecified", "unset")))
 
     def __filter_git_ignored(self, path_iter):
         try:
             git(["-C", str(self.__path), "rev-parse", "--show-toplevel"])
         except subprocess.CalledProcessError:
+            # not in a git repository: nothing is ignored
             yield from path_iter
+            return
 
         names = [p.name for p in path_iter]
 
@@ -332,10 +412,8 @@ class _RevReader(_FileReader):
             gitpath = "/".join(path)
             cmd.append(gitpath)
 
-        info = collections.OrderedDict()
-        for entry in self.__git(cmd).stdout.rstrip("\x00").split("\x00"):
-            _, objecttype, sha1, name = entry.split(maxsplit=3)
-            info[name] = name, objecttype, sha1
+        entries = (entry.split(maxsplit=3) for entry in self.__git(cmd).stdout.split("\x00") if entry)
+        info = {name: (name, objecttype, sha1) for _, objecttype, sha1, name in entries}
 
         if path is None:
             self.__ls_tree_cache = info
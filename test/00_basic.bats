@@ -35,3 +35,36 @@ setup() {
   run --separate-stderr -0 git-pile --help
   [[ "${lines[0]}" = "usage: git-pile"* ]]
 }
+
+# Command arguments are only added when the command is used: make sure the help
+# of every command still lists them
+@test "help-commands" {
+  cmds=$(git-pile -h | sed -n 's/^  {\(.*\)}$/\1/p' | tr , ' ')
+  [ -n "$cmds" ]
+
+  for cmd in $cmds; do
+    run --separate-stderr -0 git-pile "$cmd" -h
+    [[ "${lines[0]}" = "usage: git-pile $cmd"* ]]
+    [[ "$output" = *"--debug"* ]]
+  done
+
+  run --separate-stderr -0 git-pile genbranch -h
+  [[ "$output" = *"--no-cache"* ]]
+  run --separate-stderr -0 git-pile genpatches -h
+  [[ "$output" = *"--output-directory"* ]]
+}
+
+# Completion needs the arguments of all commands, not only of the one in argv
+@test "argcomplete-commands" {
+  python3 -c "import argcomplete" 2>/dev/null || skip "argcomplete not available"
+
+  complete() {
+    local line="git-pile $*"
+    COMP_LINE="$line" COMP_POINT=${#line} _ARGCOMPLETE=1 _ARGCOMPLETE_IFS=" " git-pile 8>&1 9>/dev/null
+  }
+
+  [[ " $(complete genbranch --no-c) " = *" --no-cache "* ]]
+  [[ " $(complete genpatches --) " = *" --output-directory "* ]]
+  [[ " $(complete format-patch --) " = *" --subject-prefix "* ]]
+  [[ " $(complete genbr) " = *" genbranch "* ]]
+}
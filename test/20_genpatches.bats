@@ -52,3 +52,26 @@ setup() {
   [ "$(git -C patches rev-list --count $rev0..$rev1)" -eq 1 ]
   [ "$(git -C patches log -1 --format=%s)" = "$msg" ]
 }
+
+@test "genpatches-commit-message-quoting-a-patch" {
+  echo "pile 1" > j.txt && git add j.txt && git commit -m "add j.txt"
+  prev=$(git rev-parse HEAD)
+  echo "pile 2" >> j.txt && git add j.txt && git commit -F - <<EOM
+change j.txt
+
+Quoting a patch:
+
+From 0000000000000000000000000000000000000000 Mon Sep 17 00:00:00 2001
+From $prev Mon Sep 17 00:00:00 2001
+From: Someone <someone@example.com>
+Subject: [PATCH] quoted
+EOM
+  echo "pile 3" >> j.txt && git add j.txt && git commit -m "change j.txt again"
+
+  git pile genpatches
+  run cat patches/series
+  [[ "$output" = *"0001-add-j.txt.patch"*"0001-change-j.txt.patch"*"0001-change-j.txt-again.patch"* ]]
+  grep -q "^Subject: \[PATCH\] quoted$" patches/0001-change-j.txt.patch
+  grep -q "^+pile 2$" patches/0001-change-j.txt.patch
+  grep -q "^+pile 3$" patches/0001-change-j.txt-again.patch
+}
@@ -102,6 +102,115 @@ setup() {
   [ "$head" = "$(git rev-parse HEAD)" ]
 }
 
+# A genbranch that finds everything in the cache leaves the cache file alone
+@test "genbranch-cache-not-rewritten" {
+  cache="$(git rev-parse --absolute-git-dir)/pile-genbranch-cache.pickle"
+  add_pile_commits 3 1
+  git pile genbranch -i
+  [ -f "$cache" ]
+  before=$(stat -c "%i %Y" "$cache")
+  cksum=$(sha1sum < "$cache")
+
+  git pile genbranch -i
+  [ "$(git rev-parse internal)" = "$(git rev-parse HEAD)" ]
+  [ "$(stat -c "%i %Y" "$cache")" = "$before" ]
+  [ "$(sha1sum < "$cache")" = "$cksum" ]
+}
+
+# A cache file with a different schema version is not used, but rebuilt
+@test "genbranch-cache-old-schema" {
+  cache="$(git rev-parse --absolute-git-dir)/pile-genbranch-cache.pickle"
+  add_pile_commits 3 1
+  git pile genbranch -i
+
+  # same data, but labeled with an older schema
+  python3 - "$cache" <<EOF
+import pickle, sys
+with open(sys.argv[1], "rb") as f:
+    version = pickle.load(f)
+    data = f.read()
+with open(sys.argv[1], "wb") as f:
+    pickle.dump(version - 1, f)
+    f.write(data)
+EOF
+
+  run --separate-stderr git pile genbranch -i
+  [ "$(grep -c "^Applying:" <<< "$output")" = "3" ]
+  [ "$(git rev-parse internal)" = "$(git rev-parse HEAD)" ]
+
+  # the cache was saved again with the current schema, so it's used now
+  run --separate-stderr git pile genbranch -i
+  [ "$(grep -c "^Applying:" <<< "$output")" = "0" ]
+  [ "$(git rev-parse internal)" = "$(git rev-parse HEAD)" ]
+}
+
+# A patch that can't be read aborts genbranch before any patch is applied
+@test "genbranch-unreadable-patch" {
+  add_pile_commits 3 1
+
+  patch="patches/$(grep -v -e "^#" -e "^$" patches/series | sed -n 2p)"
+  rm "$patch" && mkdir "$patch"
+
+  run --separate-stderr ! git pile genbranch -i --no-cache
+  [[ "$stderr" = *"could not read patch"* ]]
+  [ ! -d "$(git rev-parse --absolute-git-dir)/rebase-apply" ]
+  [ "$(git rev-parse HEAD)" = "$(git pile baseline)" ]
+}
+
+@test "genbranch-reusable-worktree" {
+  git config pile.genbranch-worktree-path pile-genbranch-worktree
+  worktree="$(git rev-parse --absolute-git-dir)/pile-genbranch-worktree"
+
+  add_pile_commits 3 1
+  git pile genbranch --no-cache -b tmp
+  [ "$(git rev-parse internal)" = "$(git rev-parse tmp)" ]
+  [ -d "$worktree" ]
+
+  # A later genbranch reuses the worktree left by the previous one
+  add_pile_commits 1 4
+  git pile genbranch --no-cache -b tmp
+  [ "$(git rev-parse internal)" = "$(git rev-parse tmp)" ]
+  [ "$(git -C "$worktree" rev-parse HEAD)" = "$(git rev-parse tmp)" ]
+  [ "$(git worktree list | grep -c pile-genbranch-worktree)" = "1" ]
+  [ -f "$(git rev-parse --absolute-git-dir)/git-pile-pile-genbranch-worktree.flock" ]
+
+  # If the worktree is deleted, only its own entry is dropped and it's created
+  # again; other stale worktrees are left alone
+  git worktree add --detach "$BATS_TEST_TMPDIR/other-worktree"
+  rm -rf "$worktree" "$BATS_TEST_TMPDIR/other-worktree"
+  git pile genbranch --no-cache -b tmp
+  [ "$(git rev-parse internal)" = "$(git rev-parse tmp)" ]
+  [ -d "$worktree" ]
+  [ "$(git worktree list | grep -c other-worktree)" = "1" ]
+}
+
+# A worktree path that would clobber the user's work is never used: genbranch
+# falls back to a temporary worktree
+@test "genbranch-reusable-worktree-unsafe-path" {
+  add_pile_commits 3 1
+  echo "untracked" > untracked.txt
+  echo "modified" >> $(git ls-files | head -1)
+  git diff > "$BATS_TEST_TMPDIR/user-changes.diff"
+
+  gitdir="$(git rev-parse --absolute-git-dir)"
+  for p in .. ../patches "$(pwd)" "$gitdir/objects" index HEAD config refs/heads/foo; do
+    git config pile.genbranch-worktree-path "$p"
+    git pile genbranch --no-cache -b tmp
+    [ "$(git rev-parse internal)" = "$(git rev-parse tmp)" ]
+  done
+
+  [ "$(cat untracked.txt)" = "untracked" ]
+  git diff | cmp - "$BATS_TEST_TMPDIR/user-changes.diff"
+  [ -z "$(git -C patches status --porcelain)" ]
+  [ "$(git worktree list | wc -l)" = "2" ]
+  [ ! -e "$(pwd).lock" ]
+  for f in index HEAD config; do
+    [ ! -e "$gitdir/$f.lock" ]
+    [ ! -e "$gitdir/git-pile-$f.flock" ]
+  done
+  [ ! -e "$gitdir/refs/heads/foo" ]
+}
+
 
 # Test usage of genbranch combined with the --no-config option.
 @test "genbranch-no-config" {
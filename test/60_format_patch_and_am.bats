@@ -109,3 +109,24 @@ add_commits_and_format_patch() {
   expected=""
   [ "$actual" = "$expected" ]
 }
+
+@test "format-patch-explicit-ranges" {
+  echo "pile 1" > j.txt && git add j.txt && git commit -m "1st commit"
+  git pile genpatches -c -m "First pile commit"
+  git push origin --all
+  baseline=$(git pile baseline)
+
+  echo "pile 2" >> j.txt && git add j.txt && git commit -m "2nd commit"
+  git pile format-patch -o "$BATS_TEST_TMPDIR/format-patch-out" $baseline..origin/internal $baseline..HEAD
+
+  actual=$(cd "$BATS_TEST_TMPDIR/format-patch-out" && echo *)
+  expected="0000-cover-letter.patch 0001-2nd-commit.patch 0002-full-tree-diff.patch"
+  [ "$actual" = "$expected" ]
+
+  run --separate-stderr ! git pile format-patch -o "$BATS_TEST_TMPDIR/format-patch-out" $baseline..origin/internal $baseline..nonexistent
+  [[ "$stderr" = *"does not point to a valid range"* ]]
+  [[ "$stderr" = *"nonexistent"* ]]
+
+  run --separate-stderr ! git pile format-patch -o "$BATS_TEST_TMPDIR/format-patch-out" $baseline..origin/internal HEAD
+  [[ "$stderr" = *"expands to 2 revisions"* ]]
+}